@@ -1,8 +1,16 @@
-from flask import Flask, request, render_template_string
+from flask import Flask, Response, request, stream_with_context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from collections import OrderedDict
 import urllib.parse
 import pandas as pd
 import json
+import orjson
+import os
+from route_cache import RouteCache
 
 app = Flask(__name__)
 
@@ -11,57 +19,332 @@ app = Flask(__name__)
 # =========================
 app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 10MB upload limit
 REQUEST_TIMEOUT = 10  # seconds
+GEOCODE_CACHE_SIZE = 10000  # postcodes kept in the in-process geocode cache
+MAX_WORKERS = 16  # concurrent outbound HTTP requests
+POSTCODES_BULK_LIMIT = 100  # postcodes.io limit on postcodes per bulk lookup
+# The public OSRM demo server is rate-limited and not meant for production. For batch
+# workloads run a local instance and point OSRM_BASE_URL at it, e.g. in a sidecar:
+#   osrm-extract -p /opt/car.lua england-latest.osm.pbf
+#   osrm-partition england-latest.osrm && osrm-customize england-latest.osrm
+#   osrm-routed --algorithm mld --max-table-size 1000 england-latest.osrm
+# then set OSRM_BASE_URL=http://localhost:5000 and OSRM_MAX_TABLE_COORDS=1000.
+PUBLIC_OSRM_URL = "https://router.project-osrm.org"
+OSRM_BASE_URL = os.environ.get("OSRM_BASE_URL", PUBLIC_OSRM_URL).rstrip("/")
+# Concurrent /table requests allowed; one at a time against the rate-limited public server
+OSRM_MAX_CONCURRENCY = int(
+    os.environ.get("OSRM_MAX_CONCURRENCY", 1 if OSRM_BASE_URL == PUBLIC_OSRM_URL else 4)
+)
+# Coordinates allowed per /table request (the public server allows 100)
+OSRM_MAX_TABLE_COORDS = int(os.environ.get("OSRM_MAX_TABLE_COORDS", 100))
+MAX_ORIGINS = 2000  # distinct origin postcodes accepted per upload
+UPLOAD_CHUNK_SIZE = 500  # origins geocoded and routed together per upload chunk
+DESTINATIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "destinations.json")
+ROUTE_CACHE_PATH = os.environ.get("ROUTE_CACHE_PATH", "cache.db")
+ROUTE_CACHE_TTL = 30 * 24 * 60 * 60  # seconds before a cached route is re-fetched
+
+# Shared across requests so worker threads are reused rather than respawned per upload
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+# Separate pool for /table requests so OSRM throttling never holds up geocoding threads
+OSRM_EXECUTOR = ThreadPoolExecutor(max_workers=OSRM_MAX_CONCURRENCY)
 
 # =========================
 # LOAD DESTINATIONS FROM JSON
 # =========================
-with open("destinations.json", "r") as f:
+with open(DESTINATIONS_PATH, "r") as f:
     data = json.load(f)
 
 DESTINATIONS = [d["postcode"] for d in data["destinations"]]
 AGENCY_MAP = {d["postcode"]: d["agency"] for d in data["destinations"]}
 CITY_MAP = {d["postcode"]: d["city"] for d in data["destinations"]}
 
+# Every /table request carries all destinations plus at least one origin
+if OSRM_MAX_TABLE_COORDS <= len(DESTINATIONS):
+    raise RuntimeError(
+        f"OSRM_MAX_TABLE_COORDS={OSRM_MAX_TABLE_COORDS} must be greater than the "
+        f"number of destinations ({len(DESTINATIONS)})"
+    )
+
+# =========================
+# ROUTE CACHE (SQLITE)
+# =========================
+ROUTE_CACHE = RouteCache(ROUTE_CACHE_PATH, ROUTE_CACHE_TTL)
+
 # =========================
 # HELPER FUNCTIONS
 # =========================
+_thread_local = threading.local()
+
+def get_session():
+    """Return this thread's keep-alive HTTP session, creating it on first use."""
+    session = getattr(_thread_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        # One request at a time per thread, so the adapter's default pool sizes are enough
+        adapter = HTTPAdapter(
+            max_retries=Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=(429, 502, 503, 504),
+                # Bulk postcode lookups are POSTs but read-only, so they are safe to retry
+                allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {"POST"},
+            ),
+        )
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)  # self-hosted OSRM is usually plain HTTP
+        _thread_local.session = session
+    return session
+
+def normalize_postcode(postcode):
+    """Uppercase a postcode and collapse internal whitespace ("e1  2ps" -> "E1 2PS")."""
+    return " ".join(str(postcode).upper().split())
+
+# Normalized postcode -> (lat, lon), or None for a postcode postcodes.io doesn't know.
+# Shared by geocode and bulk_geocode; least recently used entries are evicted first.
+_geocode_cache = OrderedDict()
+_geocode_cache_lock = threading.Lock()
+_NOT_CACHED = object()
+
+def _cache_get(postcode):
+    """Return cached coordinates for a normalized postcode, or _NOT_CACHED."""
+    with _geocode_cache_lock:
+        if postcode not in _geocode_cache:
+            return _NOT_CACHED
+        _geocode_cache.move_to_end(postcode)
+        return _geocode_cache[postcode]
+
+def _cache_put(postcode, coords):
+    """Cache a definitive lookup result (coordinates, or None if unknown)."""
+    with _geocode_cache_lock:
+        _geocode_cache[postcode] = coords
+        _geocode_cache.move_to_end(postcode)
+        while len(_geocode_cache) > GEOCODE_CACHE_SIZE:
+            _geocode_cache.popitem(last=False)
+
+def _lookup_postcode(postcode):
+    """Fetch coordinates for a normalized postcode, or None if it is unknown.
+
+    Network and server errors raise instead of returning None so that
+    transient failures are not cached.
+    """
+    url = f"https://api.postcodes.io/postcodes/{urllib.parse.quote(postcode)}"
+    r = get_session().get(url, timeout=REQUEST_TIMEOUT)
+    if r.status_code == 404:
+        return None
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    if data.get("status") != 200:
+        return None
+    return data["result"]["latitude"], data["result"]["longitude"]
+
 def geocode(postcode):
     """Get latitude and longitude of a postcode."""
+    postcode = normalize_postcode(postcode)
+    coords = _cache_get(postcode)
+    if coords is not _NOT_CACHED:
+        return coords
     try:
-        url = f"https://api.postcodes.io/postcodes/{urllib.parse.quote(postcode)}"
-        r = requests.get(url, timeout=REQUEST_TIMEOUT)
-        r.raise_for_status()
-        data = r.json()
-        if data.get("status") != 200:
-            return None
-        return data["result"]["latitude"], data["result"]["longitude"]
+        coords = _lookup_postcode(postcode)
     except Exception as e:
         print(f"Geocode error for {postcode}: {e}")
         return None
+    _cache_put(postcode, coords)
+    return coords
+
+def _bulk_geocode_chunk(postcodes):
+    """Geocode up to POSTCODES_BULK_LIMIT normalized postcodes with a single postcodes.io POST.
+
+    Returns a dict of postcode -> (lat, lon), or None for postcodes postcodes.io
+    doesn't know. Returns {} if the request fails, so nothing is cached.
+    """
+    try:
+        r = get_session().post(
+            "https://api.postcodes.io/postcodes",
+            data=orjson.dumps({"postcodes": postcodes}),
+            headers={"Content-Type": "application/json"},
+            timeout=REQUEST_TIMEOUT,
+        )
+        r.raise_for_status()
+        data = orjson.loads(r.content)
+        if data.get("status") != 200:
+            return {}
+        results = {}
+        # Results come back in query order, one per postcode sent
+        for postcode, item in zip(postcodes, data["result"]):
+            result = item.get("result")
+            results[postcode] = (result["latitude"], result["longitude"]) if result else None
+        return results
+    except Exception as e:
+        print(f"Bulk geocode error: {e}")
+        return {}
+
+def bulk_geocode(postcodes):
+    """Get latitude and longitude for many postcodes.
+
+    Postcodes already in the geocode cache are not sent again. Returns a dict
+    of normalized postcode -> (lat, lon); unknown postcodes are omitted.
+    """
+    found = {}
+    to_fetch = []
+    for postcode in dict.fromkeys(normalize_postcode(pc) for pc in postcodes):
+        coords = _cache_get(postcode)
+        if coords is _NOT_CACHED:
+            to_fetch.append(postcode)
+        else:
+            found[postcode] = coords
 
-def get_route(lat1, lon1, lat2, lon2):
-    """Get driving distance (km) and duration (min) between two coordinates."""
+    chunks = [to_fetch[i:i + POSTCODES_BULK_LIMIT] for i in range(0, len(to_fetch), POSTCODES_BULK_LIMIT)]
+    for chunk_results in EXECUTOR.map(_bulk_geocode_chunk, chunks):
+        for postcode, coords in chunk_results.items():
+            _cache_put(postcode, coords)
+            found[postcode] = coords
+
+    return {postcode: coords for postcode, coords in found.items() if coords}
+
+def format_coords(coords):
+    """Format a (lat, lon) tuple as the "lon,lat" string OSRM expects."""
+    lat, lon = coords
+    return f"{lon},{lat}"
+
+def get_table(origin_coord_strs, dest_coord_strs):
+    """Get driving distance (km) and duration (min) for every origin/destination pair.
+
+    Takes preformatted "lon,lat" strings (see format_coords) and uses a single
+    OSRM /table request. Returns one list per origin holding a
+    (dist_km, time_min) tuple per destination (None where no route exists),
+    or None if the request fails.
+    """
     try:
-        url = f"https://router.project-osrm.org/route/v1/driving/{lon1},{lat1};{lon2},{lat2}?overview=false"
-        r = requests.get(url, timeout=REQUEST_TIMEOUT)
+        n, m = len(origin_coord_strs), len(dest_coord_strs)
+        coords = ";".join(origin_coord_strs) + ";" + ";".join(dest_coord_strs)
+        sources = ";".join(str(i) for i in range(n))
+        destinations = ";".join(str(i) for i in range(n, n + m))
+        url = (
+            f"{OSRM_BASE_URL}/table/v1/driving/{coords}"
+            f"?sources={sources}&destinations={destinations}&annotations=duration,distance"
+        )
+        r = get_session().get(url, timeout=REQUEST_TIMEOUT)
         r.raise_for_status()
-        data = r.json()
-        if not data.get("routes"):
+        data = orjson.loads(r.content)
+        if data.get("code") != "Ok":
             return None
-        route = data["routes"][0]
-        return route["distance"] / 1000, route["duration"] / 60
+        table = []
+        for durations, distances in zip(data["durations"], data["distances"]):
+            table.append([
+                (dist / 1000, dur / 60) if dist is not None and dur is not None else None
+                for dur, dist in zip(durations, distances)
+            ])
+        return table
     except Exception as e:
-        print(f"Route error: {e}")
+        print(f"Table error: {e}")
         return None
 
+def read_origins(file):
+    """Read only the 'origin' column of an uploaded Excel file, as strings."""
+    read_kwargs = {"usecols": lambda col: col == "origin", "dtype": {"origin": "string"}}
+    try:
+        return pd.read_excel(file, engine="calamine", **read_kwargs)
+    except ImportError:
+        # python-calamine not installed; fall back to the slower pure-Python reader
+        file.seek(0)
+        return pd.read_excel(file, engine="openpyxl", **read_kwargs)
+
+def entry_rows(entries):
+    """Yield formatted result rows from (origin, dest, dist_km, time_min) tuples."""
+    for origin_pc, dest_pc, dist_km, time_min in entries:
+        yield {
+            "origin": origin_pc,
+            "dest": dest_pc,
+            "agency": AGENCY_MAP.get(dest_pc, "Unknown"),
+            "city": CITY_MAP.get(dest_pc, "Unknown"),
+            "dist": f"{dist_km:.1f}",
+            "time": f"{time_min:.1f}"
+        }
+
+def iter_rows(cached_entries, origins):
+    """Yield result rows for cached route entries and (postcode, (lat, lon)) origins.
+
+    cached_entries (from ROUTE_CACHE.lookup) are yielded first, then each
+    OSRM /table batch for the remaining origins as soon as it completes, so
+    callers can stream results instead of waiting for all.
+    """
+    dest_pcs = list(DEST_COORD_STRS.keys())
+    dest_coord_strs = list(DEST_COORD_STRS.values())
+    if not dest_coord_strs:
+        return
+
+    # Queue every /table batch before yielding; OSRM_EXECUTOR caps how many run at once
+    batch_size = OSRM_MAX_TABLE_COORDS - len(dest_coord_strs)
+    futures = {}
+    for i in range(0, len(origins), batch_size):
+        batch = origins[i:i + batch_size]
+        origin_coord_strs = [format_coords(coords) for _, coords in batch]
+        future = OSRM_EXECUTOR.submit(get_table, origin_coord_strs, dest_coord_strs)
+        futures[future] = batch
+
+    try:
+        if cached_entries:
+            yield from entry_rows(cached_entries)
+
+        for future in as_completed(futures):
+            batch = futures[future]
+            table = future.result()
+            if not table:
+                print(f"No routes returned for origins: {', '.join(pc for pc, _ in batch)}")
+                continue
+
+            new_entries = [
+                (origin_pc, dest_pc, *route)
+                for (origin_pc, _), routes in zip(batch, table)
+                for dest_pc, route in zip(dest_pcs, routes)
+                if route
+            ]
+            if not new_entries:
+                continue
+            # Write to the cache before yielding in case the client disconnects mid-stream
+            ROUTE_CACHE.put_many(new_entries)
+            yield from entry_rows(new_entries)
+    finally:
+        # If the client disconnected, don't spend OSRM requests on batches nobody will see
+        for future in futures:
+            future.cancel()
+
+def iter_upload_rows(postcodes):
+    """Yield result rows for uploaded origin postcodes, one chunk at a time.
+
+    Each chunk of UPLOAD_CHUNK_SIZE postcodes is checked against the route
+    cache, and only the misses are bulk geocoded and routed, before the next
+    chunk is started. This keeps memory bounded by the chunk size.
+    """
+    for i in range(0, len(postcodes), UPLOAD_CHUNK_SIZE):
+        chunk = postcodes[i:i + UPLOAD_CHUNK_SIZE]
+        # Fully cached origins need neither geocoding nor routing
+        cached_entries, missing = ROUTE_CACHE.lookup(chunk, DEST_COORD_STRS)
+        coords_by_pc = bulk_geocode(missing)
+
+        origins = []
+        for origin_pc in missing:
+            origin_coords = coords_by_pc.get(origin_pc)
+            if not origin_coords:
+                print(f"Skipping invalid origin: {origin_pc}")
+                continue
+            origins.append((origin_pc, origin_coords))
+
+        yield from iter_rows(cached_entries, origins)
+
 # =========================
 # PRE-CACHE DESTINATION COORDINATES
 # =========================
+_dest_results = bulk_geocode(DESTINATIONS)
 DEST_COORDS = {}
 for dest in DESTINATIONS:
-    coords = geocode(dest)
+    coords = _dest_results.get(dest)
     if coords:
         DEST_COORDS[dest] = coords
+    else:
+        print(f"Could not resolve destination coordinates, skipping: {dest}")
+
+# Formatted once here so routing requests only need to join strings
+DEST_COORD_STRS = {dest: format_coords(coords) for dest, coords in DEST_COORDS.items()}
 
 print("Cached destination coordinates:", len(DEST_COORDS))
 
@@ -113,6 +396,8 @@ PAGE = """
           <td>{{ row.dist }}</td>
           <td>{{ row.time }}</td>
         </tr>
+        {% else %}
+        <tr><td colspan="6" style="color:red;">No valid routes found.</td></tr>
         {% endfor %}
       </table>
     {% endif %}
@@ -120,6 +405,9 @@ PAGE = """
 </html>
 """
 
+# Compiled once at import rather than re-parsed on every request
+PAGE_TEMPLATE = app.jinja_env.from_string(PAGE)
+
 # =========================
 # MAIN ROUTE
 # =========================
@@ -127,73 +415,57 @@ PAGE = """
 def index():
     if request.method == "POST":
         try:
-            rows = []
-
             # ---------------- FILE UPLOAD ----------------
             file = request.files.get("file")
             if file and file.filename != "":
                 try:
-                    df = pd.read_excel(file, engine="openpyxl")
+                    df = read_origins(file)
                 except Exception as e:
-                    return render_template_string(PAGE, error=f"Excel read error: {e}")
+                    return PAGE_TEMPLATE.render(error=f"Excel read error: {e}")
 
                 if "origin" not in df.columns:
-                    return render_template_string(PAGE, error="Excel must contain column named 'origin'")
-
-                for origin_pc in df["origin"].dropna():
-                    origin_pc = str(origin_pc).strip()
-                    origin_coords = geocode(origin_pc)
-                    if not origin_coords:
-                        print(f"Skipping invalid origin: {origin_pc}")
-                        continue
-
-                    for dest_pc, dest_coords in DEST_COORDS.items():
-                        route = get_route(origin_coords[0], origin_coords[1], dest_coords[0], dest_coords[1])
-                        if route:
-                            dist_km, time_min = route
-                            rows.append({
-                                "origin": origin_pc,
-                                "dest": dest_pc,
-                                "agency": AGENCY_MAP.get(dest_pc, "Unknown"),
-                                "city": CITY_MAP.get(dest_pc, "Unknown"),
-                                "dist": f"{dist_km:.1f}",
-                                "time": f"{time_min:.1f}"
-                            })
-
-                if not rows:
-                    return render_template_string(PAGE, error="No valid routes found.")
-                return render_template_string(PAGE, rows=rows)
+                    return PAGE_TEMPLATE.render(error="Excel must contain column named 'origin'")
+
+                # Duplicate postcodes produce identical rows, so look each one up once
+                unique_pcs = [
+                    pc for pc in df["origin"].dropna().astype(str).map(normalize_postcode).unique() if pc
+                ]
+                if not unique_pcs:
+                    return PAGE_TEMPLATE.render(error="No valid routes found.")
+                if len(unique_pcs) > MAX_ORIGINS:
+                    return PAGE_TEMPLATE.render(
+                        error=f"Too many origins: {len(unique_pcs)} (maximum {MAX_ORIGINS} per upload)"
+                    )
+
+                # Stream rows to the browser as each batch of routes completes
+                return Response(
+                    stream_with_context(PAGE_TEMPLATE.generate(rows=iter_upload_rows(unique_pcs))),
+                    mimetype="text/html",
+                )
 
             # ---------------- SINGLE ORIGIN ----------------
-            origin_pc = request.form.get("Origin", "").strip()
+            origin_pc = normalize_postcode(request.form.get("Origin", ""))
             if not origin_pc:
-                return render_template_string(PAGE, error="Please enter an origin postcode or upload a file.")
+                return PAGE_TEMPLATE.render(error="Please enter an origin postcode or upload a file.")
 
-            origin_coords = geocode(origin_pc)
-            if not origin_coords:
-                return render_template_string(PAGE, error="Invalid origin postcode.")
-
-            for dest_pc, dest_coords in DEST_COORDS.items():
-                route = get_route(origin_coords[0], origin_coords[1], dest_coords[0], dest_coords[1])
-                if route:
-                    dist_km, time_min = route
-                    rows.append({
-                        "origin": origin_pc,
-                        "dest": dest_pc,
-                        "agency": AGENCY_MAP.get(dest_pc, "Unknown"),
-                        "city": CITY_MAP.get(dest_pc, "Unknown"),
-                        "dist": f"{dist_km:.1f}",
-                        "time": f"{time_min:.1f}"
-                    })
+            cached_entries, missing = ROUTE_CACHE.lookup([origin_pc], DEST_COORD_STRS)
+            origins = []
+            if missing:
+                origin_coords = geocode(origin_pc)
+                if not origin_coords:
+                    return PAGE_TEMPLATE.render(error="Invalid origin postcode.")
+                origins.append((origin_pc, origin_coords))
+
+            rows = list(iter_rows(cached_entries, origins))
 
             if not rows:
-                return render_template_string(PAGE, error="No valid routes found.")
-            return render_template_string(PAGE, rows=rows)
+                return PAGE_TEMPLATE.render(error="No valid routes found.")
+            return PAGE_TEMPLATE.render(rows=rows)
 
         except Exception as e:
-            return render_template_string(PAGE, error=f"Server Error: {e}")
+            return PAGE_TEMPLATE.render(error=f"Server Error: {e}")
 
-    return render_template_string(PAGE)
+    return PAGE_TEMPLATE.render()
 
 # =========================
 # RUN APP
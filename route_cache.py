@@ -0,0 +1,97 @@
+import sqlite3
+import threading
+import time
+
+# Stay well under SQLite's default limit of 999 bound parameters per statement
+MAX_QUERY_PARAMS = 900
+
+
+class RouteCache:
+    """Persistent SQLite cache of origin -> destination driving routes.
+
+    The cache is best-effort: SQLite errors (e.g. "database is locked" with
+    several gunicorn workers on one file) are logged and treated as misses,
+    so a cache problem never breaks a route lookup.
+    """
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS routes ("
+                "origin TEXT, dest TEXT, dist REAL, time REAL, ts INTEGER, "
+                "PRIMARY KEY (origin, dest))"
+            )
+            self._db.commit()
+        except sqlite3.Error as e:
+            print(f"Route cache disabled, could not open {path}: {e}")
+            self._db = None
+
+    def get_many(self, origins):
+        """Return {origin: {dest: (dist_km, time_min)}} for unexpired cached routes."""
+        origins = list(origins)
+        if self._db is None or not origins:
+            return {}
+
+        min_ts = int(time.time()) - self.ttl
+        found = {}
+        try:
+            with self._lock:
+                for i in range(0, len(origins), MAX_QUERY_PARAMS):
+                    part = origins[i:i + MAX_QUERY_PARAMS]
+                    placeholders = ",".join("?" * len(part))
+                    cur = self._db.execute(
+                        "SELECT origin, dest, dist, time FROM routes "
+                        f"WHERE ts >= ? AND origin IN ({placeholders})",
+                        (min_ts, *part),
+                    )
+                    for origin, dest, dist, time_min in cur.fetchall():
+                        found.setdefault(origin, {})[dest] = (dist, time_min)
+        except sqlite3.Error as e:
+            print(f"Route cache read error: {e}")
+            return {}
+        return found
+
+    def lookup(self, origins, dests):
+        """Split origins into cached result entries and origins still needing routing.
+
+        Returns (entries, missing). entries holds (origin, dest, dist_km, time_min)
+        tuples, in destination order, for origins with an unexpired route to every
+        destination; missing lists the other origins, including partial hits.
+        """
+        origins = list(origins)
+        dests = list(dests)
+        cached = self.get_many(origins)
+
+        entries = []
+        missing = []
+        for origin in origins:
+            routes = cached.get(origin)
+            if routes and all(dest in routes for dest in dests):
+                entries.extend((origin, dest, *routes[dest]) for dest in dests)
+            else:
+                missing.append(origin)
+        return entries, missing
+
+    def put_many(self, entries):
+        """Store (origin, dest, dist_km, time_min) tuples, replacing older entries."""
+        if self._db is None or not entries:
+            return
+
+        now = int(time.time())
+        try:
+            with self._lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO routes (origin, dest, dist, time, ts) VALUES (?, ?, ?, ?, ?)",
+                    [(origin, dest, dist, time_min, now) for origin, dest, dist, time_min in entries],
+                )
+                self._db.commit()
+        except sqlite3.Error as e:
+            print(f"Route cache write error: {e}")
+            try:
+                self._db.rollback()
+            except sqlite3.Error:
+                pass
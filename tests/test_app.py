@@ -0,0 +1,253 @@
+import importlib
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+from urllib.parse import parse_qs, urlsplit
+
+import pandas as pd
+import requests
+
+from route_cache import RouteCache
+
+app = None
+_tmpdir = None
+
+
+class FakeResponse:
+    def __init__(self, payload, status_code=200):
+        self.status_code = status_code
+        self.content = json.dumps(payload).encode()
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+
+def bulk_payload(postcodes, unknown=()):
+    """Build a postcodes.io bulk response; each result's latitude is its query index."""
+    return {
+        "status": 200,
+        "result": [
+            {
+                "query": pc,
+                "result": None if pc in unknown else {"latitude": 50.0 + i, "longitude": -1.0 - i},
+            }
+            for i, pc in enumerate(postcodes)
+        ],
+    }
+
+
+def _startup_request(self, method, url, data=None, **kwargs):
+    # The only request made at import is the destinations bulk geocode
+    return FakeResponse(bulk_payload(json.loads(data)["postcodes"]))
+
+
+def setUpModule():
+    global app, _tmpdir
+    _tmpdir = tempfile.TemporaryDirectory()
+    env = {"ROUTE_CACHE_PATH": os.path.join(_tmpdir.name, "startup.db")}
+    with mock.patch.dict(os.environ, env), mock.patch.object(requests.Session, "request", _startup_request):
+        app = importlib.import_module("app")
+
+
+def tearDownModule():
+    _tmpdir.cleanup()
+
+
+class AppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.session = mock.Mock()
+        patcher = mock.patch.object(app, "get_session", return_value=self.session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.route_cache = RouteCache(os.path.join(cache_dir.name, "cache.db"), ttl=3600)
+        self.addCleanup(self.route_cache._db.close)
+        patcher = mock.patch.object(app, "ROUTE_CACHE", self.route_cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        app._geocode_cache.clear()
+        self.addCleanup(app._geocode_cache.clear)
+
+
+def fake_table(origin_coord_strs, dest_coord_strs):
+    """Stand-in for get_table: origin i gets (i + 1) km and minutes to every destination."""
+    return [[(i + 1.0, i + 1.0)] * len(dest_coord_strs) for i in range(len(origin_coord_strs))]
+
+
+class GetTableTest(AppTestCase):
+    def test_url_indexes_sources_then_destinations(self):
+        self.session.get.return_value = FakeResponse(
+            {"code": "Ok", "durations": [[60] * 3] * 2, "distances": [[1000] * 3] * 2}
+        )
+
+        app.get_table(["-0.1,51.5", "-0.2,51.6"], ["-1.9,52.4", "-2.1,53.5", "-1.8,53.8"])
+
+        url = urlsplit(self.session.get.call_args[0][0])
+        self.assertTrue(url.path.endswith("/-0.1,51.5;-0.2,51.6;-1.9,52.4;-2.1,53.5;-1.8,53.8"))
+        query = parse_qs(url.query)
+        self.assertEqual(query["sources"], ["0;1"])
+        self.assertEqual(query["destinations"], ["2;3;4"])
+        self.assertEqual(query["annotations"], ["duration,distance"])
+
+    def test_converts_units_and_keeps_null_cells_as_none(self):
+        self.session.get.return_value = FakeResponse({
+            "code": "Ok",
+            "durations": [[600, None], [None, 120]],
+            "distances": [[12500, None], [3000, 2000]],
+        })
+
+        table = app.get_table(["a", "b"], ["c", "d"])
+
+        self.assertEqual(table, [[(12.5, 10.0), None], [None, (2.0, 2.0)]])
+
+    def test_returns_none_on_error_code_or_http_error(self):
+        self.session.get.return_value = FakeResponse({"code": "InvalidQuery"})
+        self.assertIsNone(app.get_table(["a"], ["b"]))
+
+        self.session.get.return_value = FakeResponse({}, status_code=429)
+        self.assertIsNone(app.get_table(["a"], ["b"]))
+
+
+class IterRowsTest(AppTestCase):
+    def test_batches_stay_within_coordinate_limit_and_are_cached(self):
+        dest_count = len(app.DEST_COORD_STRS)
+        origins = [(f"PC{i}", (51.0, -0.1)) for i in range(5)]
+        calls = []
+
+        def recording_table(origin_coord_strs, dest_coord_strs):
+            calls.append(len(origin_coord_strs) + len(dest_coord_strs))
+            return fake_table(origin_coord_strs, dest_coord_strs)
+
+        with mock.patch.object(app, "OSRM_MAX_TABLE_COORDS", dest_count + 2), \
+                mock.patch.object(app, "get_table", recording_table):
+            rows = list(app.iter_rows([], origins))
+
+        self.assertEqual(sorted(calls), [dest_count + 1, dest_count + 2, dest_count + 2])
+        self.assertEqual(len(rows), len(origins) * dest_count)
+        entries, missing = self.route_cache.lookup([pc for pc, _ in origins], app.DEST_COORD_STRS)
+        self.assertEqual(missing, [])
+        self.assertEqual(len(entries), len(rows))
+
+    def test_failed_batch_is_skipped_and_not_cached(self):
+        with mock.patch.object(app, "get_table", return_value=None):
+            rows = list(app.iter_rows([], [("PC1", (51.0, -0.1))]))
+
+        self.assertEqual(rows, [])
+        self.assertEqual(self.route_cache.lookup(["PC1"], app.DEST_COORD_STRS), ([], ["PC1"]))
+
+    def test_formats_cached_entries(self):
+        dest = next(iter(app.DEST_COORD_STRS))
+
+        rows = list(app.iter_rows([("PC1", dest, 12.345, 6.78)], []))
+
+        self.assertEqual(rows, [{
+            "origin": "PC1",
+            "dest": dest,
+            "agency": app.AGENCY_MAP[dest],
+            "city": app.CITY_MAP[dest],
+            "dist": "12.3",
+            "time": "6.8",
+        }])
+
+
+class BulkGeocodeTest(AppTestCase):
+    def test_results_are_matched_to_queries_in_order(self):
+        self.session.post.return_value = FakeResponse(
+            bulk_payload(["B19 2TP", "ZZ9 9ZZ", "OL9 6QA"], unknown={"ZZ9 9ZZ"})
+        )
+
+        coords = app.bulk_geocode(["b19  2tp", "ZZ9 9ZZ", "OL9 6QA"])
+
+        sent = json.loads(self.session.post.call_args[1]["data"])["postcodes"]
+        self.assertEqual(sent, ["B19 2TP", "ZZ9 9ZZ", "OL9 6QA"])
+        self.assertEqual(coords, {"B19 2TP": (50.0, -1.0), "OL9 6QA": (52.0, -3.0)})
+
+    def test_splits_into_chunks_of_bulk_limit(self):
+        postcodes = [f"PC{i}" for i in range(250)]
+        self.session.post.side_effect = lambda url, data, **kwargs: FakeResponse(
+            bulk_payload(json.loads(data)["postcodes"])
+        )
+
+        coords = app.bulk_geocode(postcodes)
+
+        sizes = sorted(len(json.loads(c[1]["data"])["postcodes"]) for c in self.session.post.call_args_list)
+        self.assertEqual(sizes, [50, 100, 100])
+        self.assertEqual(len(coords), 250)
+
+    def test_cached_postcodes_are_not_sent_again(self):
+        self.session.post.return_value = FakeResponse(
+            bulk_payload(["B19 2TP", "ZZ9 9ZZ"], unknown={"ZZ9 9ZZ"})
+        )
+        app.bulk_geocode(["B19 2TP", "ZZ9 9ZZ"])
+        self.session.post.reset_mock()
+
+        coords = app.bulk_geocode(["B19 2TP", "ZZ9 9ZZ"])
+
+        self.session.post.assert_not_called()
+        self.assertEqual(coords, {"B19 2TP": (50.0, -1.0)})
+        # Single lookups share the same cache
+        self.assertEqual(app.geocode("b19 2tp"), (50.0, -1.0))
+        self.session.get.assert_not_called()
+
+    def test_failed_request_is_not_cached(self):
+        self.session.post.return_value = FakeResponse({}, status_code=503)
+        self.assertEqual(app.bulk_geocode(["B19 2TP"]), {})
+
+        self.session.post.return_value = FakeResponse(bulk_payload(["B19 2TP"]))
+        self.assertEqual(app.bulk_geocode(["B19 2TP"]), {"B19 2TP": (50.0, -1.0)})
+
+
+class UploadTest(AppTestCase):
+    def test_each_chunk_is_geocoded_separately_and_cached_origins_skip_geocoding(self):
+        self.route_cache.put_many([("PC1", dest, 1.0, 2.0) for dest in app.DEST_COORD_STRS])
+        geocoded = []
+
+        def recording_bulk(postcodes):
+            geocoded.append(list(postcodes))
+            return {pc: (51.0, -0.1) for pc in postcodes if pc != "BAD"}
+
+        with mock.patch.object(app, "UPLOAD_CHUNK_SIZE", 2), \
+                mock.patch.object(app, "bulk_geocode", recording_bulk), \
+                mock.patch.object(app, "get_table", fake_table):
+            rows = list(app.iter_upload_rows(["PC0", "PC1", "PC2", "BAD", "PC4"]))
+
+        self.assertEqual(geocoded, [["PC0"], ["PC2", "BAD"], ["PC4"]])
+        self.assertEqual({row["origin"] for row in rows}, {"PC0", "PC1", "PC2", "PC4"})
+        self.assertEqual(len(rows), 4 * len(app.DEST_COORD_STRS))
+
+
+class UploadViewTest(AppTestCase):
+    def post_upload(self, origins):
+        df = pd.DataFrame({"origin": pd.Series(origins, dtype="string")})
+        with mock.patch.object(app, "read_origins", return_value=df):
+            return app.app.test_client().post(
+                "/",
+                data={"file": (io.BytesIO(b"unused"), "origins.xlsx")},
+                content_type="multipart/form-data",
+            )
+
+    def test_rejects_more_than_max_origins(self):
+        with mock.patch.object(app, "MAX_ORIGINS", 3):
+            response = self.post_upload(["A1 1AA", "B2 2BB", "C3 3CC", "D4 4DD"])
+
+        self.assertIn(b"Too many origins: 4 (maximum 3 per upload)", response.data)
+
+    def test_duplicates_count_once_towards_the_limit(self):
+        with mock.patch.object(app, "MAX_ORIGINS", 3), \
+                mock.patch.object(app, "bulk_geocode", lambda pcs: {pc: (51.0, -0.1) for pc in pcs}), \
+                mock.patch.object(app, "get_table", fake_table):
+            response = self.post_upload(["a1 1aa", " A1  1AA", "B2 2BB", "C3 3CC", None])
+
+        self.assertNotIn(b"Too many origins", response.data)
+        self.assertEqual(response.data.count(b"<td>A1 1AA</td>"), len(app.DEST_COORD_STRS))
+
+
+if __name__ == "__main__":
+    unittest.main()
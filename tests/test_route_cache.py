@@ -0,0 +1,91 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from route_cache import RouteCache
+
+DESTS = ["E1 2PS", "LU4 8HZ"]
+
+
+class RouteCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = RouteCache(os.path.join(self.tmpdir.name, "cache.db"), ttl=3600)
+
+    def tearDown(self):
+        self.cache._db.close()
+        self.tmpdir.cleanup()
+
+    def test_write_back_then_full_hit(self):
+        self.cache.put_many([
+            ("B19 2TP", "LU4 8HZ", 90.0, 70.0),
+            ("B19 2TP", "E1 2PS", 190.5, 150.0),
+        ])
+
+        entries, missing = self.cache.lookup(["B19 2TP"], DESTS)
+
+        # Entries come back in destination order regardless of insert order
+        self.assertEqual(entries, [
+            ("B19 2TP", "E1 2PS", 190.5, 150.0),
+            ("B19 2TP", "LU4 8HZ", 90.0, 70.0),
+        ])
+        self.assertEqual(missing, [])
+
+    def test_partial_hit_is_a_miss(self):
+        self.cache.put_many([("B19 2TP", "E1 2PS", 190.5, 150.0)])
+
+        entries, missing = self.cache.lookup(["B19 2TP", "OL9 6QA"], DESTS)
+
+        self.assertEqual(entries, [])
+        self.assertEqual(missing, ["B19 2TP", "OL9 6QA"])
+
+    def test_expired_entries_are_misses_until_rewritten(self):
+        self.cache.put_many([
+            ("B19 2TP", "E1 2PS", 190.5, 150.0),
+            ("B19 2TP", "LU4 8HZ", 90.0, 70.0),
+        ])
+        self.cache._db.execute("UPDATE routes SET ts = ts - ?", (self.cache.ttl + 1,))
+        self.cache._db.commit()
+
+        self.assertEqual(self.cache.lookup(["B19 2TP"], DESTS), ([], ["B19 2TP"]))
+
+        self.cache.put_many([
+            ("B19 2TP", "E1 2PS", 191.0, 151.0),
+            ("B19 2TP", "LU4 8HZ", 90.0, 70.0),
+        ])
+        entries, missing = self.cache.lookup(["B19 2TP"], DESTS)
+        self.assertEqual(entries[0], ("B19 2TP", "E1 2PS", 191.0, 151.0))
+        self.assertEqual(missing, [])
+
+    def test_many_origins_in_one_lookup(self):
+        origins = [f"PC{i}" for i in range(1000)]
+        self.cache.put_many([(pc, dest, 1.0, 2.0) for pc in origins for dest in DESTS])
+
+        entries, missing = self.cache.lookup(origins, DESTS)
+
+        self.assertEqual(len(entries), len(origins) * len(DESTS))
+        self.assertEqual(missing, [])
+
+    def test_sqlite_errors_are_treated_as_misses(self):
+        class LockedConnection:
+            def execute(self, *args):
+                raise sqlite3.OperationalError("database is locked")
+
+            executemany = execute
+
+            def rollback(self):
+                pass
+
+            def close(self):
+                pass
+
+        self.cache._db.close()
+        self.cache._db = LockedConnection()
+
+        self.cache.put_many([("B19 2TP", "E1 2PS", 190.5, 150.0)])
+        self.assertEqual(self.cache.lookup(["B19 2TP"], DESTS), ([], ["B19 2TP"]))
+
+
+if __name__ == "__main__":
+    unittest.main()